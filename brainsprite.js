@@ -1,28 +1,30 @@
+// Default viewer parameters, shared by all viewers - for internal use
+var defaultParams = {
+  projection: false,
+  smooth: false,
+  flagValue: false,
+  colorBackground: '#000000',
+  flagCoordinates: false,
+  origin: { X: 0, Y: 0, Z: 0 },
+  voxelSize: 1,
+  affine: false,
+  heightColorBar: 0.04,
+  sizeFont: 0.075,
+  fontFamily: 'Arial',
+  colorFont: '#FFFFFF',
+  nbDecimals: 3,
+  crosshair: false,
+  colorCrosshair: '#0000FF',
+  sizeCrosshair: 0.9,
+  title: false,
+  numSlice: false,
+  onclick: '',
+  opacity: 1
+}
+
 function initBrain (params) {
   // Parameter initialization - for internal use
 
-  var defaultParams = {
-    projection: false,
-    smooth: false,
-    flagValue: false,
-    colorBackground: '#000000',
-    flagCoordinates: false,
-    origin: { X: 0, Y: 0, Z: 0 },
-    voxelSize: 1,
-    affine: false,
-    heightColorBar: 0.04,
-    sizeFont: 0.075,
-    fontFamily: 'Arial',
-    colorFont: '#FFFFFF',
-    nbDecimals: 3,
-    crosshair: false,
-    colorCrosshair: '#0000FF',
-    sizeCrosshair: 0.9,
-    title: false,
-    numSlice: false,
-    onclick: '',
-    opacity: 1
-  }
   var brain = Object.assign({}, defaultParams, params)
 
   // Build affine, if not specified
@@ -59,21 +61,14 @@ function initCanvas (brain, canvas) {
   brain.context = brain.canvas.getContext('2d')
   brain.context.imageSmoothingEnabled = brain.smooth
 
-  // An in-memory canvas to draw intermediate reconstruction
-  // of the coronal slice, at native resolution
-  brain.canvasY = document.createElement('canvas')
-  brain.contextY = brain.canvasY.getContext('2d')
-
-  // An in-memory canvas to draw intermediate reconstruction
-  // of the axial slice, at native resolution
-  brain.canvasZ = document.createElement('canvas')
-  brain.contextZ = brain.canvasZ.getContext('2d')
-
   // An in-memory canvas to read the value of pixels
   brain.canvasRead = document.createElement('canvas')
   brain.contextRead = brain.canvasRead.getContext('2d')
   brain.canvasRead.width = 1
   brain.canvasRead.height = 1
+  // Voxel reads must be nearest-neighbour: interpolated samples would
+  // blend neighbouring voxels and corrupt the colormap lookup
+  brain.contextRead.imageSmoothingEnabled = false
 
   // A master sagital canvas for the merge of background and overlay
   brain.planes = {}
@@ -121,7 +116,7 @@ function initOverlay (brain, sprite, nbSlice) {
   return brain
 }
 
-function initColorMap (colorMap) {
+function initColorMap (colorMap, nbDecimals) {
   // Initialize the color map - for internal use.
   colorMap.img = document.getElementById(colorMap.img)
   colorMap.hide =
@@ -133,6 +128,11 @@ function initColorMap (colorMap) {
   colorMap.context.drawImage(colorMap.img,
     0, 0, colorMap.img.width, colorMap.img.height,
     0, 0, colorMap.img.width, colorMap.img.height)
+  // The colorbar labels are fixed for a given colormap, so format them once
+  colorMap.labelMin = Number.parseFloat(colorMap.min).toPrecision(
+    nbDecimals).replace(/0+$/, '')
+  colorMap.labelMax = Number.parseFloat(colorMap.max).toPrecision(
+    nbDecimals).replace(/0+$/, '')
   return colorMap
 }
 
@@ -181,7 +181,7 @@ var brainsprite = function (params) {
     brain = initOverlay(brain, params.overlay.sprite, params.overlay.nbSlice)
   };
   if (params.colorMap) {
-    brain.colorMap = initColorMap(params.colorMap)
+    brain.colorMap = initColorMap(params.colorMap, brain.nbDecimals)
   };
 
   let getValue = function (rgb, colorMap) {
@@ -191,17 +191,29 @@ var brainsprite = function (params) {
     }
     var cv, dist, nbColor, ind, val, voxelValue
     nbColor = colorMap.canvas.width
+    if (!colorMap.data) {
+      // Cache the first row of colormap pixels on first use, so later
+      // lookups do not read them back from the canvas one by one. The
+      // read stays inside the try/catch of updateValue, which handles
+      // tainted or not-yet-loaded colormap images by disabling lookups
+      colorMap.data = colorMap.context.getImageData(0, 0, nbColor, 1).data
+    }
+    cv = colorMap.data
     ind = NaN
     val = Infinity
     let xx = 0
     for (xx = 0; xx < nbColor; xx++) {
-      cv = colorMap.context.getImageData(xx, 0, 1, 1).data
-      dist = Math.pow(cv[0] - rgb[0], 2) +
-              Math.pow(cv[1] - rgb[1], 2) +
-              Math.pow(cv[2] - rgb[2], 2)
+      let dR = cv[4 * xx] - rgb[0]
+      let dG = cv[4 * xx + 1] - rgb[1]
+      let dB = cv[4 * xx + 2] - rgb[2]
+      dist = dR * dR + dG * dG + dB * dB
       if (dist < val) {
         ind = xx
         val = dist
+        // An exact match cannot be improved upon
+        if (dist === 0) {
+          break
+        }
       }
     }
     voxelValue =
@@ -211,33 +223,31 @@ var brainsprite = function (params) {
 
   let updateValue = function () {
     // Update voxel value
-    let pos = {}; let test1 = []; let test2 = []
-    if (brain.overlay && !brain.nanValue) {
+    let pos = {}
+    // The voxel value is only consumed by the value display and the
+    // onclick callback, so skip the canvas readback when neither is used
+    if (brain.overlay && !brain.nanValue &&
+        (brain.flagValue || brain.onclick)) {
       try {
         pos.XW = Math.round((brain.numSlice.X) % brain.nbCol)
         pos.XH = Math.round((brain.numSlice.X - pos.XW) / brain.nbCol)
-        brain.contextRead.fillStyle = '#FFFFFF'
-        brain.contextRead.fillRect(0, 0, 1, 1)
-        brain.contextRead.drawImage(
-          brain.overlay.sprite.bitmap,
-          pos.XW * brain.nbSlice.Y + brain.numSlice.Y,
-          pos.XH * brain.nbSlice.Z + brain.nbSlice.Z - brain.numSlice.Z - 1,
-          1, 1, 0, 0, 1, 1)
-        let rgb = {}
-        rgb = brain.contextRead.getImageData(0, 0, 1, 1).data
-        test1 = ((rgb[0] === 255) && (rgb[1] === 255) && (rgb[2] === 255))
-        brain.contextRead.fillStyle = '#000000'
-        brain.contextRead.fillRect(0, 0, 1, 1)
+        brain.contextRead.clearRect(0, 0, 1, 1)
         brain.contextRead.drawImage(
           brain.overlay.sprite.bitmap,
           pos.XW * brain.nbSlice.Y + brain.numSlice.Y,
           pos.XH * brain.nbSlice.Z + brain.nbSlice.Z - brain.numSlice.Z - 1,
           1, 1, 0, 0, 1, 1)
-        rgb = brain.contextRead.getImageData(0, 0, 1, 1).data
-        test2 = ((rgb[0] === 0) && (rgb[1] === 0) && (rgb[2] === 0))
-        if (test1 && test2) {
+        let rgb = brain.contextRead.getImageData(0, 0, 1, 1).data
+        if (rgb[3] === 0) {
           brain.voxelValue = NaN
         } else {
+          if (rgb[3] < 255) {
+            // Composite over a black background, as the colormap lookup
+            // expects opaque colors
+            rgb[0] = rgb[0] * rgb[3] / 255
+            rgb[1] = rgb[1] * rgb[3] / 255
+            rgb[2] = rgb[2] * rgb[3] / 255
+          }
           brain.voxelValue = getValue(rgb, brain.colorMap)
         }
       } catch (err) {
@@ -248,34 +258,26 @@ var brainsprite = function (params) {
     } else {
       brain.voxelValue = NaN
     };
-  }
-
-  let multiply = function (a, b) {
-    // Multiply two matrices A and B
-    let aNumRows = a.length; let aNumCols = a[0].length
-    let bNumCols = b[0].length
-    let m = new Array(aNumRows) // initialize array of rows
-    for (var r = 0; r < aNumRows; ++r) {
-      m[r] = new Array(bNumCols) // initialize the current row
-      for (var c = 0; c < bNumCols; ++c) {
-        m[r][c] = 0 // initialize the current cell
-        for (var i = 0; i < aNumCols; ++i) {
-          m[r][c] += a[r][i] * b[i][c]
-        }
-      }
-    }
-    return m
+    // Format the display label here, once per value change, rather than
+    // on every redraw of the sagital slice
+    brain.valueLabel = 'value = ' +
+      Number.parseFloat(brain.voxelValue).toPrecision(brain.nbDecimals)
+        .replace(/0+$/, '')
   }
 
   let updateCoordinates = function () {
-    let coordVoxel = multiply(brain.affine,
-      [ [brain.numSlice.X + 1],
-        [brain.numSlice.Y + 1],
-        [brain.numSlice.Z + 1],
-        [1] ])
-    brain.coordinatesSlice.X = coordVoxel[0]
-    brain.coordinatesSlice.Y = coordVoxel[1]
-    brain.coordinatesSlice.Z = coordVoxel[2]
+    // Apply the affine to the voxel coordinates directly, without
+    // building matrices for a generic product
+    let aff = brain.affine
+    let vx = brain.numSlice.X + 1
+    let vy = brain.numSlice.Y + 1
+    let vz = brain.numSlice.Z + 1
+    brain.coordinatesSlice.X =
+      aff[0][0] * vx + aff[0][1] * vy + aff[0][2] * vz + aff[0][3]
+    brain.coordinatesSlice.Y =
+      aff[1][0] * vx + aff[1][1] * vy + aff[1][2] * vz + aff[1][3]
+    brain.coordinatesSlice.Z =
+      aff[2][0] * vx + aff[2][1] * vy + aff[2][2] * vz + aff[2][3]
   }
 
   //* **********************//
@@ -283,6 +285,7 @@ var brainsprite = function (params) {
   //* **********************//
   brain.init = function () {
     let clientWidth = brain.canvas.parentElement.clientWidth
+    brain.widthParent = clientWidth
     let nX = brain.nbSlice.X; let nY = brain.nbSlice.Y; let nZ = brain.nbSlice.Z
 
     if (brain.projection) {
@@ -298,20 +301,25 @@ var brainsprite = function (params) {
     brain.context.font = brain.sizeFontPixels + `px "${brain.fontFamily}"`
 
     // Draw the Master canvas
-    brain.planes.canvasMaster.width = brain.sprite.width
-    brain.planes.canvasMaster.height = brain.sprite.height
-    brain.planes.contextMaster.globalAlpha = 1
-
-    brain.planes.contextMaster.drawImage(brain.sprite.bitmap,
-      0, 0, brain.sprite.width, brain.sprite.height,
-      0, 0, brain.sprite.width, brain.sprite.height)
-
-    if (brain.overlay) {
-      // Draw the overlay on a canvas
-      brain.planes.contextMaster.globalAlpha = brain.opacity
-      brain.planes.contextMaster.drawImage(brain.overlay.sprite.bitmap,
-        0, 0, brain.overlay.sprite.width, brain.overlay.sprite.height,
+    // The master composite only depends on the sprite and the overlay,
+    // so it is built once and reused when init runs again (e.g. on resize)
+    if (!brain.planes.masterReady) {
+      brain.planes.canvasMaster.width = brain.sprite.width
+      brain.planes.canvasMaster.height = brain.sprite.height
+      brain.planes.contextMaster.globalAlpha = 1
+
+      brain.planes.contextMaster.drawImage(brain.sprite.bitmap,
+        0, 0, brain.sprite.width, brain.sprite.height,
         0, 0, brain.sprite.width, brain.sprite.height)
+
+      if (brain.overlay) {
+        // Draw the overlay on a canvas
+        brain.planes.contextMaster.globalAlpha = brain.opacity
+        brain.planes.contextMaster.drawImage(brain.overlay.sprite.bitmap,
+          0, 0, brain.overlay.sprite.width, brain.overlay.sprite.height,
+          0, 0, brain.sprite.width, brain.sprite.height)
+      };
+      brain.planes.masterReady = true
     };
 
     // Draw the X canvas (sagital)
@@ -414,15 +422,18 @@ var brainsprite = function (params) {
     let offX = Math.ceil((1 - brain.sizeCrosshair) * brain.nbSlice.X / 2)
     let offY = Math.ceil((1 - brain.sizeCrosshair) * brain.nbSlice.Y / 2)
     let offZ = Math.ceil((1 - brain.sizeCrosshair) * brain.nbSlice.Z / 2)
-    let nY = brain.nbSlice.Y; let nZ = brain.nbSlice.Z; let xx
+    let nX = brain.nbSlice.X; let nY = brain.nbSlice.Y
+    let nZ = brain.nbSlice.Z; let nbCol = brain.nbCol
+    let master = brain.planes.canvasMaster
+    let xx; let posW; let posH
 
     // Now draw the slice
     switch (type) {
       case 'X':
         // Draw a sagital slice in memory
-        pos.XW = ((brain.numSlice.X) % brain.nbCol)
-        pos.XH = (brain.numSlice.X - pos.XW) / brain.nbCol
-        brain.planes.contextX.drawImage(brain.planes.canvasMaster,
+        pos.XW = ((brain.numSlice.X) % nbCol)
+        pos.XH = (brain.numSlice.X - pos.XW) / nbCol
+        brain.planes.contextX.drawImage(master,
           pos.XW * nY, pos.XH * nZ, nY, nZ,
           0, 0, nY, nZ)
 
@@ -455,11 +466,9 @@ var brainsprite = function (params) {
 
         // Draw the value at current voxel
         if (brain.flagValue) {
-          let value = 'value = ' +
-            Number.parseFloat(brain.voxelValue).toPrecision(brain.nbDecimals)
-              .replace(/0+$/, '')
           brain.context.fillStyle = brain.colorFont
-          brain.context.fillText(value, Math.round(brain.widthCanvas.X / 10),
+          brain.context.fillText(brain.valueLabel,
+            Math.round(brain.widthCanvas.X / 10),
             Math.round((brain.heightCanvas.max * brain.heightColorBar * 2) +
             (3 / 4) * (brain.sizeFontPixels)))
         }
@@ -479,12 +488,19 @@ var brainsprite = function (params) {
         brain.context.fillStyle = brain.colorBackground
         brain.context.fillRect(brain.widthCanvas.X, 0, brain.widthCanvas.Y,
           brain.canvas.height)
-        for (xx = 0; xx < brain.nbSlice.X; xx++) {
-          let posW = (xx % brain.nbCol)
-          let posH = (xx - posW) / brain.nbCol
-          brain.planes.contextY.drawImage(brain.planes.canvasMaster,
-            posW * brain.nbSlice.Y + brain.numSlice.Y, posH * brain.nbSlice.Z,
-            1, brain.nbSlice.Z, xx, 0, 1, brain.nbSlice.Z)
+        let contextY = brain.planes.contextY
+        let sliceY = brain.numSlice.Y
+        posW = 0
+        posH = 0
+        for (xx = 0; xx < nX; xx++) {
+          contextY.drawImage(master,
+            posW * nY + sliceY, posH * nZ,
+            1, nZ, xx, 0, 1, nZ)
+          // Walk the mosaic grid instead of recomputing a mod/div per slice
+          if (++posW === nbCol) {
+            posW = 0
+            posH++
+          }
         }
 
         // Add a crosshair
@@ -511,10 +527,8 @@ var brainsprite = function (params) {
             brain.heightColorBar / 2), Math.round(brain.widthCanvas.Y * 0.6),
             Math.round(brain.heightCanvas.max * brain.heightColorBar))
           brain.context.fillStyle = brain.colorFont
-          let labelMin = Number.parseFloat(brain.colorMap.min).toPrecision(
-            brain.nbDecimals).replace(/0+$/, '')
-          let labelMax = Number.parseFloat(brain.colorMap.max).toPrecision(
-            brain.nbDecimals).replace(/0+$/, '')
+          let labelMin = brain.colorMap.labelMin
+          let labelMax = brain.colorMap.labelMax
           brain.context.fillText(labelMin, brain.widthCanvas.X +
             (brain.widthCanvas.Y * 0.2) -
             brain.context.measureText(labelMin).width / 2,
@@ -544,12 +558,18 @@ var brainsprite = function (params) {
         brain.context.fillStyle = brain.colorBackground
         brain.context.fillRect(brain.widthCanvas.X + brain.widthCanvas.Y, 0,
           brain.widthCanvas.Z, brain.canvas.height)
-        for (xx = 0; xx < brain.nbSlice.X; xx++) {
-          let posW = (xx % brain.nbCol)
-          let posH = (xx - posW) / brain.nbCol
-          brain.planes.contextZ.drawImage(brain.planes.canvasMaster,
-            posW * brain.nbSlice.Y, posH * brain.nbSlice.Z + brain.nbSlice.Z -
-            brain.numSlice.Z - 1, brain.nbSlice.Y, 1, 0, xx, brain.nbSlice.Y, 1)
+        let contextZ = brain.planes.contextZ
+        let rowZ = nZ - brain.numSlice.Z - 1
+        posW = 0
+        posH = 0
+        for (xx = 0; xx < nX; xx++) {
+          contextZ.drawImage(master,
+            posW * nY, posH * nZ + rowZ,
+            nY, 1, 0, xx, nY, 1)
+          if (++posW === nbCol) {
+            posW = 0
+            posH++
+          }
         }
 
         // Add a crosshair
@@ -592,8 +612,12 @@ var brainsprite = function (params) {
     let coordWidth
     let xx
     let pos = {}
+    let nX = brain.nbSlice.X
     let nY = brain.nbSlice.Y
     let nZ = brain.nbSlice.Z
+    let nbCol = brain.nbCol
+    let master = brain.planes.canvasMaster
+    let posW; let posH
     let plane
 
     brain.context.font = brain.sizeFontPixels + `px "${brain.fontFamily}"`
@@ -603,9 +627,9 @@ var brainsprite = function (params) {
       case 'X':
         plane = 'Sagittal'
         // Draw a sagital slice in memory
-        pos.XW = ((brain.numSlice.X) % brain.nbCol)
-        pos.XH = (brain.numSlice.X - pos.XW) / brain.nbCol
-        brain.planes.contextX.drawImage(brain.planes.canvasMaster,
+        pos.XW = ((brain.numSlice.X) % nbCol)
+        pos.XH = (brain.numSlice.X - pos.XW) / nbCol
+        brain.planes.contextX.drawImage(master,
           pos.XW * nY, pos.XH * nZ, nY, nZ,
           0, 0, nY, nZ)
 
@@ -624,12 +648,18 @@ var brainsprite = function (params) {
         plane = 'Coronal'
         // Draw a single coronal slice at native resolution
         brain.context.fillRect(0, 0, brain.widthCanvas.max, brain.canvas.height)
-        for (xx = 0; xx < brain.nbSlice.X; xx++) {
-          let posW = (xx % brain.nbCol)
-          let posH = (xx - posW) / brain.nbCol
-          brain.planes.contextY.drawImage(brain.planes.canvasMaster,
-            posW * brain.nbSlice.Y + brain.numSlice.Y, posH * brain.nbSlice.Z,
-            1, brain.nbSlice.Z, xx, 0, 1, brain.nbSlice.Z)
+        let contextY = brain.planes.contextY
+        let sliceY = brain.numSlice.Y
+        posW = 0
+        posH = 0
+        for (xx = 0; xx < nX; xx++) {
+          contextY.drawImage(master,
+            posW * nY + sliceY, posH * nZ,
+            1, nZ, xx, 0, 1, nZ)
+          if (++posW === nbCol) {
+            posW = 0
+            posH++
+          }
         }
 
         // Redraw the coronal slice in the canvas at screen resolution
@@ -644,12 +674,18 @@ var brainsprite = function (params) {
         plane = 'Axial'
         // Draw a single axial slice at native resolution
         brain.context.fillRect(0, 0, brain.widthCanvas.max, brain.canvas.height)
-        for (xx = 0; xx < brain.nbSlice.X; xx++) {
-          let posW = (xx % brain.nbCol)
-          let posH = (xx - posW) / brain.nbCol
-          brain.planes.contextZ.drawImage(brain.planes.canvasMaster,
-            posW * brain.nbSlice.Y, posH * brain.nbSlice.Z + brain.nbSlice.Z -
-            brain.numSlice.Z - 1, brain.nbSlice.Y, 1, 0, xx, brain.nbSlice.Y, 1)
+        let contextZ = brain.planes.contextZ
+        let rowZ = nZ - brain.numSlice.Z - 1
+        posW = 0
+        posH = 0
+        for (xx = 0; xx < nX; xx++) {
+          contextZ.drawImage(master,
+            posW * nY, posH * nZ + rowZ,
+            nY, 1, 0, xx, nY, 1)
+          if (++posW === nbCol) {
+            posW = 0
+            posH++
+          }
         }
 
         // Redraw the axial slice in the canvas at screen resolution
@@ -878,9 +914,21 @@ var brainsprite = function (params) {
     scrollHandler(e)
   }, false)
 
+  // Coalesce bursts of resize events into a single re-layout per frame
+  let resizePending = false
   window.addEventListener('resize', function () {
-    brain.init()
-    brain.renderProjections()
+    // The layout only depends on the width of the parent element, so
+    // height-only resizes do not require a new layout and redraw
+    if (resizePending ||
+        brain.canvas.parentElement.clientWidth === brain.widthParent) {
+      return
+    }
+    resizePending = true
+    window.requestAnimationFrame(function () {
+      resizePending = false
+      brain.init()
+      brain.renderProjections()
+    })
   }, false)
 
   // Init the viewer